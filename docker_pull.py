@@ -2,57 +2,163 @@
 
 import argparse
 import base64
+import copy
 import datetime
 import gzip
 import hashlib
 import json
 import logging
 import os
+import queue
+import re
 import requests
 import shutil
 import struct
 import tarfile
+import threading
+import time
 import typing
 import urllib.parse as urlparse
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-from collections import OrderedDict
 from dateutil.tz import tzlocal
 from dateutil.parser import parse as date_parse
 from sys import platform as platform_system
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # TODO: v1_layers_ids, empty_manifest, empty_layer_json use like a struct in golang
 # TODO: add function like a digest.Digister in moby/moby
 
 JSON_SEPARATOR = (',', ':')
 DOCKER_REGISTRY_HOST = 'registry-1.docker.io'
+DOWNLOAD_BUFFER_SIZE = 1 << 20
 
+# tzlocal() re-reads system tz configuration on every call; one lookup
+# at import covers the whole run
+LOCAL_TIMEZONE = tzlocal()
 
-def www_auth(hdr: str) -> dict:
-    ret = {}
 
-    auth_type, info = hdr.split(' ', 1)
-    auth_type = auth_type.lower()
-    ret[auth_type] = {}
+def _best_sha256():
+    """Pick the fastest SHA-256 constructor available.
 
-    for part in info.split(','):
-        k, v = part.split('=', 1)
-        ret[auth_type][k] = v.lower().replace('"', '')
+    hashlib.sha256 is normally OpenSSL's, which dispatches to the SHA-NI /
+    ARMv8-crypto code paths at runtime (OpenSSL >= 1.1.1) when the CPU
+    supports them. Only a CPython built without OpenSSL falls back to the
+    slow pure-C _sha256 module; in that case the `cryptography` package
+    (if installed) gets us back onto OpenSSL.
+    """
+    if getattr(hashlib.sha256, '__module__', '') == '_hashlib':
+        return hashlib.sha256
 
-    return ret
+    try:
+        from cryptography.hazmat.primitives.hashes import Hash, SHA256
+    except ImportError:
+        return hashlib.sha256
 
+    class _OpenSSLSha256:
+        def __init__(self, data=b''):
+            self._h = Hash(SHA256())
+            if data:
+                self._h.update(data)
 
-def chain_ids(ids: list) -> list:
-    chain = list()
-    chain.append(ids[0])
+        def update(self, data):
+            self._h.update(data)
 
-    if len(ids) < 2:
-        return ids
+        def digest(self):
+            return self._h.copy().finalize()
+
+        def hexdigest(self):
+            return self.digest().hex()
+
+    return _OpenSSLSha256
+
+
+_sha256 = _best_sha256()
+
+
+def _sha256_hex(data: bytes) -> str:
+    # .digest().hex() skips the hexdigest buffer inside the EVP code and
+    # is measurably faster for the many small chain/v1 id digests
+    return _sha256(data).digest().hex()
+
+
+def json_dumps(obj) -> bytes:
+    if orjson is not None:
+        # orjson keeps dict insertion order and emits the same compact
+        # separators as JSON_SEPARATOR, so digests stay stable.
+        return orjson.dumps(obj)
+
+    # ensure_ascii=False matches orjson's raw UTF-8 output byte for byte;
+    # the default \uXXXX escaping would change digests for non-ASCII configs
+    return json.dumps(obj, separators=JSON_SEPARATOR, ensure_ascii=False).encode()
 
-    nxt = list()
-    nxt.append("sha256:" + hashlib.sha256(f'{ids[0]} {ids[1]}'.encode()).hexdigest())
-    nxt.extend(ids[2:])
 
-    chain.extend(chain_ids(nxt))
+_EMPTY_CONTAINER_CONFIG = dict(
+    Hostname="",
+    Domainname="",
+    User="",
+    AttachStdin=False,
+    AttachStdout=False,
+    AttachStderr=False,
+    Tty=False,
+    OpenStdin=False,
+    StdinOnce=False,
+    Env=None,
+    Cmd=None,
+    Image="",
+    Volumes=None,
+    WorkingDir="",
+    Entrypoint=None,
+    OnBuild=None,
+    Labels=None
+)
+
+_EMPTY_LAYER_JSON_MID = dict(
+    created="1970-01-01T00:00:00Z",
+    container_config=_EMPTY_CONTAINER_CONFIG,
+    os='linux'
+)
+
+_EMPTY_LAYER_JSON_LAST = dict(
+    created="1970-01-01T00:00:00Z",
+    container='',
+    container_config=_EMPTY_CONTAINER_CONFIG,
+    docker_version='18.06.1-ce',
+    config='',
+    architecture='',
+    os='linux'
+)
+
+
+_WWW_AUTH_RE = re.compile(r'(\w+)=(?:"([^"]*)"|([^",]+))')
+
+
+def www_auth(hdr: str) -> dict:
+    auth_type, info = hdr.split(' ', 1)
+
+    # single regex pass over the header; commas inside quoted values are
+    # legal per RFC 7235 and no longer break the parse
+    return {auth_type.lower(): {k: (quoted or plain).lower()
+                                for k, quoted, plain in _WWW_AUTH_RE.findall(info)}}
+
+
+def chain_ids(ids: list) -> list:
+    if len(ids) < 2:
+        return ids[:]
+
+    chain = [ids[0]]
+    prev = ids[0]
+    for nxt in ids[1:]:
+        prev = "sha256:" + _sha256_hex(prev.encode() + b' ' + nxt.encode())
+        chain.append(prev)
 
     return chain
 
@@ -62,7 +168,7 @@ def v1_layers_ids(chain_ids_list, config_image):
     parent = ''
     for chain_id in chain_ids_list:
         if chain_id == chain_ids_list[-1]:
-            cfg = OrderedDict(
+            cfg = dict(
                 architecture='amd64',
                 config='',
                 container='',
@@ -81,26 +187,8 @@ def v1_layers_ids(chain_ids_list, config_image):
 
             cfg.update(v1_img)
         else:
-            cfg = OrderedDict(
-                container_config=OrderedDict(
-                    Hostname="",
-                    Domainname="",
-                    User="",
-                    AttachStdin=False,
-                    AttachStdout=False,
-                    AttachStderr=False,
-                    Tty=False,
-                    OpenStdin=False,
-                    StdinOnce=False,
-                    Env=None,
-                    Cmd=None,
-                    Image="",
-                    Volumes=None,
-                    WorkingDir="",
-                    Entrypoint=None,
-                    OnBuild=None,
-                    Labels=None
-                ),
+            cfg = dict(
+                container_config=_EMPTY_CONTAINER_CONFIG.copy(),
                 created="1970-01-01T00:00:00Z",
                 layer_id=chain_id,
             )
@@ -108,31 +196,37 @@ def v1_layers_ids(chain_ids_list, config_image):
             if parent:
                 cfg['parent'] = parent
 
-        j = json.dumps(cfg, separators=JSON_SEPARATOR)
-        parent = "sha256:" + hashlib.sha256(j.encode()).hexdigest()
+        j = json_dumps(cfg)
+        parent = "sha256:" + _sha256_hex(j)
         r.append(parent)
 
     return r
 
 
-def sha256sum(filename, chunk_size=16384):
-    h = hashlib.sha256()
+def sha256sum(filename):
     with open(filename, 'rb', buffering=0) as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+        # Python < 3.11 fallback
+        h = _sha256()
         while 1:
-            chunk = memoryview(f.read(chunk_size))
+            chunk = f.read(16384)
             if not chunk:
                 break
             h.update(chunk)
-    return h.hexdigest()
+        return h.hexdigest()
 
 
-def sizeof_fmt(num):
-    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
-        if abs(num) < 1024:
-            return f'{num:3.1f}{unit}'
-        num /= 1024
+_SIZE_UNITS = ('B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB')
+
 
-    return f'{num:3.1f}PiB'
+def sizeof_fmt(num):
+    # bit_length picks the unit in constant time: every 10 bits is one
+    # 1024 step up the unit ladder
+    n = int(abs(num)) or 1
+    i = min((n.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f'{num / (1 << (10 * i)):3.1f}{_SIZE_UNITS[i]}'
 
 
 def progress_bar(description, content_length, done, progressbar_length=50):
@@ -150,6 +244,27 @@ def progress_bar(description, content_length, done, progressbar_length=50):
     print(" " * len(progress_bar_str) + "\r", end='')
 
 
+class Progress:
+    """Throttles progress_bar repaints to ~30 Hz.
+
+    The download/extract loops iterate far faster than a terminal can
+    redraw; skipping repaints closer than 33 ms apart drops ~99% of the
+    formatting and flush work with no visible change.
+    """
+    __slots__ = ('_last',)
+
+    def __init__(self):
+        self._last = 0.0
+
+    def maybe(self, description, content_length, done):
+        now = time.monotonic()
+        if now - self._last < 0.033:
+            return
+
+        self._last = now
+        progress_bar(description, content_length, done)
+
+
 class FileExporter:
     def __init__(self, temp_dir, work_dir='.'):
         self._path = os.path.join(work_dir, temp_dir)
@@ -225,28 +340,34 @@ class TarExporter(tarfile.TarInfo):
         """Return a header block. info is a dictionary with file
            information, format must be one of the *_FORMAT constants.
         """
-        parts = [
-            tarfile.stn(info.get("name", ""), 100, encoding, errors),
-            tarfile.itn(info.get("mode", 0), 8, format_),
-            tarfile.itn(info.get("uid", 0), 8, format_),
-            tarfile.itn(info.get("gid", 0), 8, format_),
-            tarfile.itn(info.get("size", 0), 12, format_),
-            tarfile.itn(info.get("mtime", 0), 12, format_),
-            b" " * 8,  # checksum field
-            info.get("type", tarfile.REGTYPE),
-            tarfile.stn(info.get("linkname", ""), 100, encoding, errors),
-            info.get("magic", tarfile.POSIX_MAGIC),
-            tarfile.stn(info.get("uname", ""), 32, encoding, errors),
-            tarfile.stn(info.get("gname", ""), 32, encoding, errors),
-            tarfile.itn(info.get("devmajor", 0), 8, format_),
-            tarfile.itn(info.get("devminor", 0), 8, format_),
-            tarfile.stn(info.get("prefix", ""), 155, encoding, errors)
-        ]
-
-        buf = struct.pack("%ds" % tarfile.BLOCKSIZE, b"".join(parts))
-        chksum = tarfile.calc_chksums(buf[-tarfile.BLOCKSIZE:])[0]
-        buf = buf[:-364] + bytes("%06o\0" % chksum, "ascii") + buf[-357:]
-        return buf
+        # the bytearray is zero-filled already, so blank string fields
+        # (linkname, prefix, and uname/gname with numeric_owner) are
+        # NUL-padded for free and skip the stn call entirely
+        buf = bytearray(tarfile.BLOCKSIZE)
+        if info.get("name"):
+            buf[0:100] = tarfile.stn(info["name"], 100, encoding, errors)
+        buf[100:108] = tarfile.itn(info.get("mode", 0), 8, format_)
+        buf[108:116] = tarfile.itn(info.get("uid", 0), 8, format_)
+        buf[116:124] = tarfile.itn(info.get("gid", 0), 8, format_)
+        buf[124:136] = tarfile.itn(info.get("size", 0), 12, format_)
+        buf[136:148] = tarfile.itn(info.get("mtime", 0), 12, format_)
+        buf[148:156] = b" " * 8  # checksum field
+        buf[156:157] = info.get("type", tarfile.REGTYPE)
+        if info.get("linkname"):
+            buf[157:257] = tarfile.stn(info["linkname"], 100, encoding, errors)
+        buf[257:265] = info.get("magic", tarfile.POSIX_MAGIC)
+        if info.get("uname"):
+            buf[265:297] = tarfile.stn(info["uname"], 32, encoding, errors)
+        if info.get("gname"):
+            buf[297:329] = tarfile.stn(info["gname"], 32, encoding, errors)
+        buf[329:337] = tarfile.itn(info.get("devmajor", 0), 8, format_)
+        buf[337:345] = tarfile.itn(info.get("devminor", 0), 8, format_)
+        if info.get("prefix"):
+            buf[345:500] = tarfile.stn(info["prefix"], 155, encoding, errors)
+
+        # with the checksum field blanked to spaces this equals calc_chksums
+        buf[148:155] = b"%06o\0" % sum(buf)
+        return bytes(buf)
 
 
 class TarFile(tarfile.TarFile):
@@ -264,6 +385,47 @@ class TarFile(tarfile.TarFile):
 
         self._added_paths_list = []
 
+    def addfile(self, tarinfo, fileobj=None):
+        # zero-copy path: splice regular files into the archive with
+        # os.sendfile instead of shuttling chunks through Python buffers.
+        # Linux only - darwin/BSD sendfile(2) needs a socket out_fd and
+        # rejects offset=None
+        if fileobj is None or not platform_system.startswith('linux') or not hasattr(os, 'sendfile'):
+            return super().addfile(tarinfo, fileobj)
+
+        try:
+            in_fd = fileobj.fileno()
+            out_fd = self.fileobj.fileno()
+        except (AttributeError, OSError):
+            return super().addfile(tarinfo, fileobj)
+
+        self._check('awx')
+        tarinfo = copy.copy(tarinfo)
+
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+        # the header sits in the buffered writer; flush before writing
+        # past it at the fd level
+        self.fileobj.flush()
+
+        remaining = tarinfo.size
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, None, remaining)
+            if sent == 0:
+                raise tarfile.ReadError('unexpected end of data')
+            remaining -= sent
+
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+
+        self.members.append(tarinfo)
+        return tarinfo
+
     def add(self, name, arcname=None, recursive=True, *, filter_=None, created=None):
         if name.split(os.path.sep)[0] not in self._added_paths_list:
             self._added_paths_list.append(name)
@@ -274,47 +436,46 @@ class TarFile(tarfile.TarFile):
         if created is None:
             created = datetime.datetime.now().isoformat()
 
-        for d in sorted(os.listdir(name)):
-            file_path = os.path.join(name, d)
-            arc_name = os.path.relpath(file_path, arcname)
+        ct_time = date_parse(created).astimezone(LOCAL_TIMEZONE)
+        created_mod_time = (ct_time.timestamp(), ct_time.timestamp())
 
-            # # tuple(atime, mtime)
-            if os.path.basename(file_path) in ['manifest.json', 'repositories']:
-                mod_time = (0.0, 0.0)
-                ct_time = datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc).astimezone(tzlocal())
+        for dir_path, dir_names, file_names in os.walk(name):
+            dir_names.sort()
 
-                if platform_system.startswith("win"):
-                    print(
-                        f'!!!WARNING: Creation time for file {file_path} will not be changed. Image hash sum will be different')
+            for d in sorted(dir_names + file_names):
+                file_path = os.path.join(dir_path, d)
+                arc_name = os.path.relpath(file_path, arcname)
+
+                # tuple(atime, mtime); ustar headers only store mtime, so
+                # os.utime is all the archive needs - st_ctime is neither
+                # settable from userspace nor read by tarfile
+                if d in ['manifest.json', 'repositories']:
+                    mod_time = (0.0, 0.0)
                 else:
-                    # kludge: Python can't change st_ctime
-                    os.system('$(which touch) -c -t {} {}'.format(ct_time.strftime('%Y%m%d%H%M'), file_path))
-            else:
-                ct_time = date_parse(created).astimezone(tzlocal())
-                mod_time = (ct_time.timestamp(), ct_time.timestamp())
+                    mod_time = created_mod_time
 
-            os.utime(file_path, mod_time)
+                os.utime(file_path, mod_time)
 
-            tarinfo = self.gettarinfo(file_path, arc_name)
+                tarinfo = self.gettarinfo(file_path, arc_name)
 
-            tarinfo.uid = self._owner
-            tarinfo.gid = self._group
+                tarinfo.uid = self._owner
+                tarinfo.gid = self._group
 
-            if self._numeric_owner:
-                tarinfo.uname = ''
-                tarinfo.gname = ''
+                if self._numeric_owner:
+                    tarinfo.uname = ''
+                    tarinfo.gname = ''
 
-            if platform_system.startswith("darwin") and self._owner == 0 and self._group == 0:
-                # kludge: for mac os
-                tarinfo.uname = 'root'
-                tarinfo.gname = 'root'
+                if platform_system.startswith("darwin") and self._owner == 0 and self._group == 0:
+                    # kludge: for mac os
+                    tarinfo.uname = 'root'
+                    tarinfo.gname = 'root'
 
-            if os.path.isdir(file_path):
-                self.addfile(tarinfo)
-                self.add(file_path, name, recursive=recursive, filter_=filter_, created=created)
-            else:
-                with open(file_path, "rb") as f:
-                    self.addfile(tarinfo, f)
+                if d in dir_names:
+                    # directory contents are emitted when os.walk reaches it
+                    self.addfile(tarinfo)
+                else:
+                    with open(file_path, "rb") as f:
+                        self.addfile(tarinfo, f)
 
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is None:
@@ -337,6 +498,15 @@ class ImageFetcher:
         self._user = user
         self._password = password
         self._session = requests.Session()
+        self._auth_lock = threading.Lock()
+
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
 
         if verbose:
             self._log_level = logging.INFO if verbose == 1 else logging.DEBUG
@@ -346,8 +516,13 @@ class ImageFetcher:
         return urlparse.urlunsplit(('https' if self._ssl else 'http', registry, f'/v2/{ns}/', None, None))
 
     def _auth(self, resp: requests.Response):
-        if self._session.headers.get('Authorization'):
-            del self._session.headers['Authorization']
+        # concurrent 401s from the layer download threads must not race
+        # the header swap; one refresh at a time is enough for all of them
+        with self._auth_lock:
+            self._do_auth(resp)
+
+    def _do_auth(self, resp: requests.Response):
+        self._session.headers.pop('Authorization', None)
 
         if self._user:
             auth_hdr = base64.b64encode(f'{self._user}:{self._password}'.encode())
@@ -369,11 +544,11 @@ class ImageFetcher:
 
             self._session.headers['Authorization'] = 'Bearer {}'.format(r.json()['token'])
 
-    def _req(self, url, *, method='GET', stream=None):
-        r = self._session.request(method, url, stream=stream)
+    def _req(self, url, *, method='GET', stream=None, headers=None):
+        r = self._session.request(method, url, stream=stream, headers=headers)
         if r.status_code == requests.codes.unauthorized:
             self._auth(r)
-            r = self._session.request(method, url, stream=stream)
+            r = self._session.request(method, url, stream=stream, headers=headers)
 
         if r.status_code == requests.codes.ok or \
                 r.status_code == requests.codes.created or \
@@ -395,14 +570,15 @@ class ImageFetcher:
         self._session.headers['Accept'] = 'application/vnd.docker.distribution.manifest.list.v2+json'
         return self._manifests_req(url, tag)
 
-    def get_blob(self, url: str, tag: str, stream: bool = False) -> requests.Response:
+    def get_blob(self, url: str, tag: str, stream: bool = False, headers: dict = None) -> requests.Response:
         if stream:
-            self._session.headers['Accept'] = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
-        return self._req(urlparse.urljoin(url, f'blobs/{tag}'), stream=stream)
+            headers = dict(headers or {})
+            headers['Accept'] = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+        return self._req(urlparse.urljoin(url, f'blobs/{tag}'), stream=stream, headers=headers)
 
     @property
     def empty_manifest(self):
-        return [OrderedDict(
+        return [dict(
             Config='',
             RepoTags=[],
             Layers=[]
@@ -410,36 +586,7 @@ class ImageFetcher:
 
     # TODO: remove last_layer arg
     def empty_layer_json(self, *, image_os: str = 'linux', last_layer: bool = False):
-        od = OrderedDict(created="1970-01-01T00:00:00Z")
-
-        if last_layer:
-            od['container'] = ''
-
-        od['container_config'] = OrderedDict(
-            Hostname="",
-            Domainname="",
-            User="",
-            AttachStdin=False,
-            AttachStdout=False,
-            AttachStderr=False,
-            Tty=False,
-            OpenStdin=False,
-            StdinOnce=False,
-            Env=None,
-            Cmd=None,
-            Image="",
-            Volumes=None,
-            WorkingDir="",
-            Entrypoint=None,
-            OnBuild=None,
-            Labels=None
-        )
-
-        if last_layer:
-            od['docker_version'] = '18.06.1-ce'
-            od['config'] = ''
-            od['architecture'] = ''
-
+        od = copy.deepcopy(_EMPTY_LAYER_JSON_LAST if last_layer else _EMPTY_LAYER_JSON_MID)
         od['os'] = image_os
 
         return od
@@ -472,37 +619,119 @@ class ImageFetcher:
     def _get_layer(self, url, layer_digest, diff_id, output_file):
         gziped_file = f'{output_file}.gz'
         layer_id_short = layer_digest[7:19]
+        req_headers = None
+        prog = Progress()
 
         if os.path.exists(output_file):
-            if sha256sum(output_file) != diff_id[7:]:
-                self._session.headers['Range'] = 'bytes={}-'.format(os.path.getsize(gziped_file))
+            if os.path.exists(gziped_file):
+                req_headers = {'Range': 'bytes={}-'.format(os.path.getsize(gziped_file))}
                 open_file_mode = 'ab'
                 logging.debug(f'File {output_file} is exist, resume download')
             else:
+                # the .gz sidecar is only removed once the diff_id has been
+                # verified, so a bare layer.tar is already complete - no
+                # need to re-hash the whole layer to find that out
                 print("\r{}: Pull complete {}".format(layer_id_short, " " * 100), flush=True)
                 logging.debug(f'File {output_file} is exist, download next blob')
                 return
         else:
             open_file_mode = 'wb'
 
-        r = self.get_blob(url, layer_digest, stream=True)
+        r = self.get_blob(url, layer_digest, stream=True, headers=req_headers)
         logging.debug(f'Blob headers: {layer_digest}: {r.headers}')
 
         content_length = int(r.headers.get('Content-Length', 0))
 
+        if open_file_mode == 'wb':
+            # Fresh download: decompress and hash on the fly so the blob is
+            # only read once. The .gz sidecar is still written for resume.
+            # Decompression runs on a worker thread fed through a bounded
+            # queue - zlib releases the GIL, so the network-bound download
+            # and the CPU-bound gunzip genuinely overlap.
+            decomp = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            h = _sha256()
+            q = queue.Queue(maxsize=8)
+            errors = []
+
+            with open(gziped_file, 'wb') as file, open(output_file, 'wb') as unzip_data:
+                def unpack():
+                    sentinel_seen = False
+                    try:
+                        while 1:
+                            chunk = q.get()
+                            if chunk is None:
+                                sentinel_seen = True
+                                break
+                            data = decomp.decompress(chunk)
+                            if data:
+                                h.update(data)
+                                unzip_data.write(data)
+
+                        data = decomp.flush()
+                        if data:
+                            h.update(data)
+                            unzip_data.write(data)
+                    except Exception as e:
+                        errors.append(e)
+                        # keep draining so a blocked producer can never
+                        # deadlock on the bounded queue - but only until
+                        # the sentinel; past it the queue stays empty and
+                        # another q.get would block forever
+                        if not sentinel_seen:
+                            while q.get() is not None:
+                                pass
+
+                worker = threading.Thread(target=unpack)
+                worker.start()
+
+                try:
+                    done = 0
+                    buf = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+                    while 1:
+                        n = r.raw.readinto(buf)
+                        if not n:
+                            break
+                        if errors:
+                            # unpack thread died (e.g. corrupt gzip data);
+                            # no point downloading the rest of the blob
+                            break
+                        file.write(buf[:n])
+                        q.put(bytes(buf[:n]))
+                        done += n
+
+                        prog.maybe(f"{layer_id_short}: Downloading", content_length, done)
+                finally:
+                    # always send the sentinel, even when readinto raises
+                    # mid-body - otherwise the worker waits forever
+                    q.put(None)
+                    worker.join()
+
+            if errors:
+                raise errors[0]
+
+            if h.hexdigest() != diff_id[7:]:
+                # drop the corrupt files, otherwise every later run would
+                # resume from them and hit the same mismatch forever
+                os.remove(gziped_file)
+                os.remove(output_file)
+                raise Exception(f'Layer {layer_digest} digest mismatch: expected {diff_id}')
+
+            os.remove(gziped_file)
+            print("\r{}: Pull complete {}".format(layer_id_short, " " * 100), flush=True)
+            return
+
         if r.status_code != 416:
             with open(gziped_file, open_file_mode) as file:
                 done = 0
-                chunk_size = 8192
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        file.write(chunk)
-                        done += len(chunk)
-
-                        progress_bar(f"{layer_id_short}: Downloading", content_length, done)
+                buf = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+                while 1:
+                    n = r.raw.readinto(buf)
+                    if not n:
+                        break
+                    file.write(buf[:n])
+                    done += n
 
-        if 'Range' in self._session.headers:
-            del self._session.headers['Range']
+                    prog.maybe(f"{layer_id_short}: Downloading", content_length, done)
 
         with gzip.open(gziped_file, 'rb') as gz_data, open(output_file, 'wb') as unzip_data:
             gz_data.myfileobj.seek(-4, 2)
@@ -518,7 +747,14 @@ class ImageFetcher:
                 unzip_data.write(chunk)
                 done += len(chunk)
 
-                progress_bar(f"{layer_id_short}: Extracting", isize, done)
+                prog.maybe(f"{layer_id_short}: Extracting", isize, done)
+
+        if sha256sum(output_file) != diff_id[7:]:
+            # drop the corrupt files, otherwise every later run would
+            # resume from them and hit the same mismatch forever
+            os.remove(gziped_file)
+            os.remove(output_file)
+            raise Exception(f'Layer {layer_digest} digest mismatch: expected {diff_id}')
 
         os.remove(gziped_file)
         print("\r{}: Pull complete {}".format(layer_id_short, " " * 100), flush=True)
@@ -562,7 +798,7 @@ class ImageFetcher:
         with saver(config_filename) as f:
             f.write(image_config.content)
 
-        image_config = image_config.json(object_pairs_hook=OrderedDict)
+        image_config = image_config.json()
         diff_ids = image_config['rootfs']['diff_ids']
 
         layers = image_manifest['layers']
@@ -572,18 +808,26 @@ class ImageFetcher:
         chain_ids_list = chain_ids(diff_ids)
         v1_layer_ids_list = v1_layers_ids(chain_ids_list, image_config)
 
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            jobs = []
+            for i, layer_info in enumerate(layers):
+                v1_layer_id = v1_layer_ids_list[i][7:]
+
+                man[0]['Layers'].append(f'{v1_layer_id}/layer.tar')
+                layer_tar = saver.path_join(v1_layer_id, 'layer.tar')
+
+                jobs.append(pool.submit(self._get_layer, url, layer_info['digest'], diff_ids[i], layer_tar))
+
+            for job in jobs:
+                job.result()
+
         v1_layer_id = ''
         parent_id = ''
         for i, layer_info in enumerate(layers):
             last_layer = layer_info == layers[-1]
             v1_layer_id = v1_layer_ids_list[i][7:]
 
-            man[0]['Layers'].append(f'{v1_layer_id}/layer.tar')
-            layer_tar = saver.path_join(v1_layer_id, 'layer.tar')
-
-            self._get_layer(url, layer_info['digest'], diff_ids[i], layer_tar)
-
-            layer_json = OrderedDict(id=v1_layer_id)
+            layer_json = dict(id=v1_layer_id)
             if parent_id:
                 layer_json['parent'] = parent_id
 
@@ -596,7 +840,7 @@ class ImageFetcher:
                 del layer_json['rootfs']
 
             with saver(v1_layer_id, "json") as f:
-                f.write(json.dumps(layer_json, separators=JSON_SEPARATOR))
+                f.write(json_dumps(layer_json))
 
             with saver(v1_layer_id, "VERSION") as f:
                 f.write("1.0")
@@ -606,11 +850,11 @@ class ImageFetcher:
         print('Digest:', manifests_list.headers.get('Docker-Content-Digest'))
 
         with saver("manifest.json") as f:
-            f.write(json.dumps(man, separators=JSON_SEPARATOR))
+            f.write(json_dumps(man))
             f.write('\n')
 
         with saver("repositories") as f:
-            f.write(json.dumps({image_repo: {tag: v1_layer_id}}, separators=JSON_SEPARATOR))
+            f.write(json_dumps({image_repo: {tag: v1_layer_id}}))
             f.write('\n')
 
         with TarFile.open(f'{image_name}.tar', 'w', remove_src_dir=True) as tar: